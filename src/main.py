@@ -2,10 +2,17 @@ import os
 import logging
 import dotenv
 import asyncio
+import functools
 import aiosqlite
-from enum import StrEnum, auto
+from aiosqlitepool import SQLiteConnectionPool
+from enum import StrEnum
 from typing import Final, Union
 
+try:
+    import uvloop
+except ImportError: # Not available on Windows
+    uvloop = None
+
 from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.types import (
     Message,
@@ -15,82 +22,234 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     CallbackQuery,
 )
-from aiogram.filters import Command, StateFilter
+from aiogram.filters import Command, StateFilter, Filter
 from aiogram.filters.callback_data import CallbackData
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 
+dotenv.load_dotenv()
+
 # Logs
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+CAT_PREFIX: Final = "📁 "
+
+DB_PATH: Final = "../databases/tasks.db"
+DB_POOL_SIZE: Final = 8
+DB_PRAGMAS: Final = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-20000",
+    "mmap_size=268435456",
+    "foreign_keys=ON",
+)
+SCHEMA_VERSION: Final = 1
+TASKS_DDL: Final = "(id INTEGER PRIMARY KEY, cat_id INTEGER REFERENCES categories(id) ON DELETE CASCADE, chat_id INTEGER, msg_id INTEGER)"
+SCHEMA_SQL: Final = f"""
+    CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+    CREATE TABLE IF NOT EXISTS tasks {TASKS_DDL};
+    CREATE INDEX IF NOT EXISTS idx_tasks_cat_id ON tasks(cat_id);
+"""
+
 class Action(StrEnum):
-    LIST_ALL = auto()
-    EDIT_ITEM = auto()
-    RENAME = auto()
-    DELETE = auto()
-    ADD_NEW = auto()
-    DELETE_TASK = auto()
-    MAIN_MENU = auto()
+    # One-char values keep callback_data well under Telegram's 64 bytes
+    LIST_ALL = "l"
+    EDIT_ITEM = "e"
+    RENAME = "r"
+    DELETE = "x"
+    ADD_NEW = "a"
+    DELETE_TASK = "d"
+    MAIN_MENU = "m"
 
 class CatOpCB(CallbackData, prefix="op"):
     action: Action
     id: int = 0
 
+# Packed "op:<action>:" per action, used to build and route callback data without the model
+_CB_PREFIXES: Final = {a: CatOpCB(action=a).pack().rsplit(":", 1)[0] + ":" for a in Action}
+
+def pack_cb(action: Action, item_id: int = 0) -> str:
+    return f"{_CB_PREFIXES[action]}{item_id}"
+
 class BotState(StatesGroup):
     in_category = State() # Состояние активного просмотра/добавления
     waiting_new_cat = State()
     waiting_rename = State()
 
+# --- Filters ---
+
+class TextPrefix(Filter):
+    """Matches text starting with prefix and passes the remainder to the handler as `key`"""
+    def __init__(self, prefix: str, key: str):
+        self.prefix = prefix
+        self.key = key
+
+    async def __call__(self, message: Message) -> bool | dict:
+        if message.text and message.text.startswith(self.prefix):
+            return {self.key: message.text[len(self.prefix):]}
+        return False
+
+class CallbackAction(Filter):
+    """Routes packed CatOpCB data on its action prefix and passes the id as `item_id`"""
+    def __init__(self, action: Action):
+        self.prefix = _CB_PREFIXES[action]
+
+    async def __call__(self, call: CallbackQuery) -> bool | dict:
+        if call.data and call.data.startswith(self.prefix):
+            try: return {"item_id": int(call.data[len(self.prefix):])}
+            except ValueError: return False
+        return False
+
 # --- Middleware ---
 
 class DbSessionMiddleware(BaseMiddleware):
-    def __init__(self, connection: aiosqlite.Connection):
+    """Hands handlers the pool; they check out a connection only around their queries,
+    so none is held through Telegram I/O"""
+    def __init__(self, pool: SQLiteConnectionPool):
         super().__init__()
-        self.connection = connection
+        self.pool = pool
 
     async def __call__(self, handler, event: TelegramObject, data: dict):
-        data["db"] = self.connection
+        data["db_pool"] = self.pool
         return await handler(event, data)
 
+# --- Session ---
+
+class KeepAliveSession(AiohttpSession):
+    """Keeps idle sockets to the Bot API open between bursts of calls"""
+    def __init__(self, keepalive_timeout: float = 60, **kwargs):
+        super().__init__(**kwargs)
+        # Private aiogram attribute: kwargs for the TCPConnector it creates
+        self._connector_init["keepalive_timeout"] = keepalive_timeout
+
 # --- Keyboards ---
 
+# Built main menu, reset whenever the category list changes
+_main_menu_cache: ReplyKeyboardMarkup | None = None
+# Bumped on every invalidation; a fill that raced one is not stored
+_categories_gen = 0
+
+# Category name -> id, filled lazily by show_content
+_cat_id_cache: dict[str, int] = {}
+
+def invalidate_main_menu():
+    global _main_menu_cache, _categories_gen
+    _main_menu_cache = None
+    _categories_gen += 1
+
+def forget_category(cat_id: int):
+    global _categories_gen
+    _categories_gen += 1
+    for name, cid in list(_cat_id_cache.items()):
+        if cid == cat_id:
+            del _cat_id_cache[name]
+
+# Static markups, built once
+_CANCEL_KB: Final = ReplyKeyboardBuilder().add(KeyboardButton(text="❌ Cancel")).as_markup(resize_keyboard=True)
+_MANAGE_KB: Final = InlineKeyboardBuilder().button(text="⚙️ Manage Categories", callback_data=pack_cb(Action.LIST_ALL)).as_markup()
+
 class KBs:
     @staticmethod
-    async def main_menu_reply(db: aiosqlite.Connection) -> ReplyKeyboardMarkup:
+    def cancel_reply() -> ReplyKeyboardMarkup:
+        return _CANCEL_KB
+
+    @staticmethod
+    def manage_inline() -> InlineKeyboardMarkup:
+        return _MANAGE_KB
+
+    @staticmethod
+    @functools.lru_cache(maxsize=512)
+    def task_actions(task_id: int) -> InlineKeyboardMarkup:
+        return InlineKeyboardBuilder().button(text="🗑", callback_data=pack_cb(Action.DELETE_TASK, task_id)).as_markup()
+
+    @staticmethod
+    async def main_menu_reply(db_pool: SQLiteConnectionPool) -> ReplyKeyboardMarkup:
+        global _main_menu_cache
+        if _main_menu_cache is not None:
+            return _main_menu_cache
+
+        gen = _categories_gen
+        async with db_pool.connection() as db:
+            names = await db.execute_fetchall("SELECT name FROM categories")
         builder = ReplyKeyboardBuilder()
-        async with db.execute("SELECT name FROM categories") as cursor:
-            async for (name,) in cursor:
-                builder.add(KeyboardButton(text=f"📁 {name}"))
+        for (name,) in names:
+            builder.add(KeyboardButton(text=f"{CAT_PREFIX}{name}"))
         builder.add(KeyboardButton(text="⚙️ Manage Categories"))
         builder.adjust(2)
-        return builder.as_markup(resize_keyboard=True)
+        markup = builder.as_markup(resize_keyboard=True)
+        if gen == _categories_gen:
+            _main_menu_cache = markup
+        return markup
 
     @staticmethod
     def category_mgmt_list(categories: list) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
-        builder.button(text="➕ Add Category", callback_data=CatOpCB(action=Action.ADD_NEW))
+        builder.button(text="➕ Add Category", callback_data=pack_cb(Action.ADD_NEW))
         for cid, name in categories:
-            builder.button(text=f"📂 {name}", callback_data=CatOpCB(action=Action.EDIT_ITEM, id=cid))
-        builder.button(text="⬅️ Back to Menu", callback_data=CatOpCB(action=Action.MAIN_MENU))
+            builder.button(text=f"📂 {name}", callback_data=pack_cb(Action.EDIT_ITEM, cid))
+        builder.button(text="⬅️ Back to Menu", callback_data=pack_cb(Action.MAIN_MENU))
         builder.adjust(1)
         return builder.as_markup()
 
     @staticmethod
+    @functools.lru_cache(maxsize=512)
     def cat_edit_actions(cat_id: int) -> InlineKeyboardMarkup:
         builder = InlineKeyboardBuilder()
-        builder.button(text="✏️ Rename", callback_data=CatOpCB(action=Action.RENAME, id=cat_id))
-        builder.button(text="🔥 Delete", callback_data=CatOpCB(action=Action.DELETE, id=cat_id))
-        builder.button(text="⬅️ Back", callback_data=CatOpCB(action=Action.LIST_ALL))
+        builder.button(text="✏️ Rename", callback_data=pack_cb(Action.RENAME, cat_id))
+        builder.button(text="🔥 Delete", callback_data=pack_cb(Action.DELETE, cat_id))
+        builder.button(text="⬅️ Back", callback_data=pack_cb(Action.LIST_ALL))
         builder.adjust(2, 1)
         return builder.as_markup()
 
 # --- Helpers ---
 
-async def delete_msg(bot: Bot, chat_id: int, mid: int):
+async def delete_msg(bot: Bot, chat_id: int, mid: int | None):
+    if mid is None: return
     try: await bot.delete_message(chat_id, mid)
-    except: pass
+    except Exception as e: logger.debug("Could not delete message %s: %s", mid, e)
+
+async def copy_task(bot: Bot, chat_id: int, tid: int, from_chat_id: int, msg_id: int, attempts: int = 3):
+    """Copies a saved task into the chat, waiting out flood control"""
+    for attempt in range(attempts):
+        try:
+            await bot.copy_message(chat_id, from_chat_id, msg_id, reply_markup=KBs.task_actions(tid))
+            return
+        except TelegramRetryAfter as e:
+            if attempt == attempts - 1:
+                logger.warning("Gave up copying task %s after %s flood-limited attempts", tid, attempts)
+                return
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.warning("Failed to copy task %s: %s", tid, e)
+            return
+
+# Strong refs so pending background writes aren't garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def insert_task(pool: SQLiteConnectionPool, cat_id: int, chat_id: int, msg_id: int) -> bool:
+    """Returns False if the row could not be written, e.g. the category was deleted meanwhile"""
+    try:
+        async with pool.connection() as db:
+            await db.execute(
+                "INSERT INTO tasks (cat_id, chat_id, msg_id) VALUES (?, ?, ?)",
+                (cat_id, chat_id, msg_id)
+            )
+            await db.commit()
+        return True
+    except Exception:
+        logger.exception("Failed to save message %s to category %s", msg_id, cat_id)
+        return False
 
 # --- Handlers ---
 
@@ -98,34 +257,31 @@ dp = Dispatcher()
 
 @dp.message(Command("start"))
 @dp.message(F.text == "❌ Cancel")
-async def cmd_start(message: Message, db: aiosqlite.Connection, state: FSMContext):
+async def cmd_start(message: Message, db_pool: SQLiteConnectionPool, state: FSMContext):
     data = await state.get_data()
     await delete_msg(message.bot, message.chat.id, data.get("last_mid"))
 
     await state.clear()
-    kb = await KBs.main_menu_reply(db)
+    kb = await KBs.main_menu_reply(db_pool)
     msg = await message.answer(
         "🗂 **Main Menu**",
         reply_markup=kb,
         parse_mode="Markdown"
     )
     # Inline switcher for management
-    inline_kb = InlineKeyboardBuilder().button(text="⚙️ Manage Categories", callback_data=CatOpCB(action=Action.LIST_ALL)).as_markup()
-    await msg.edit_reply_markup(reply_markup=inline_kb)
+    await msg.edit_reply_markup(reply_markup=KBs.manage_inline())
     await state.update_data(last_mid=msg.message_id)
 
-@dp.callback_query(CatOpCB.filter(F.action == Action.MAIN_MENU))
-async def back_to_main_callback(call: CallbackQuery, db: aiosqlite.Connection, state: FSMContext):
-    await cmd_start(call.message, db, state)
+@dp.callback_query(CallbackAction(Action.MAIN_MENU))
+async def back_to_main_callback(call: CallbackQuery, db_pool: SQLiteConnectionPool, state: FSMContext):
+    await cmd_start(call.message, db_pool, state)
     await call.answer()
 
 @dp.message(F.text == "⚙️ Manage Categories")
-@dp.callback_query(CatOpCB.filter(F.action == Action.LIST_ALL))
-async def list_cats(event: Message | CallbackQuery, db: aiosqlite.Connection, state: FSMContext):
-    cats = []
-    async with db.execute("SELECT id, name FROM categories") as cursor:
-        async for row in cursor: cats.append(row)
-
+@dp.callback_query(CallbackAction(Action.LIST_ALL))
+async def list_cats(event: Message | CallbackQuery, db_pool: SQLiteConnectionPool, state: FSMContext):
+    async with db_pool.connection() as db:
+        cats = await db.execute_fetchall("SELECT id, name FROM categories")
     kb = KBs.category_mgmt_list(cats)
     text = "🛠 **Category Management**"
 
@@ -138,94 +294,137 @@ async def list_cats(event: Message | CallbackQuery, db: aiosqlite.Connection, st
         await event.message.edit_text(text, reply_markup=kb, parse_mode="Markdown")
         await event.answer()
 
-@dp.message(F.text.startswith("📁 "))
-async def show_content(message: Message, db: aiosqlite.Connection, state: FSMContext):
-    cat_name = message.text[2:]
-    async with db.execute("SELECT id FROM categories WHERE name = ?", (cat_name,)) as cursor:
-        row = await cursor.fetchone()
-    if not row: return
+@dp.message(TextPrefix(CAT_PREFIX, "cat_name"))
+async def show_content(message: Message, cat_name: str, db_pool: SQLiteConnectionPool, state: FSMContext):
+    async with db_pool.connection() as db:
+        cat_id = _cat_id_cache.get(cat_name)
+        if cat_id is None:
+            gen = _categories_gen
+            rows = await db.execute_fetchall("SELECT id FROM categories WHERE name = ?", (cat_name,))
+            if not rows: return
+            cat_id = rows[0][0]
+            # Skip storing if a category was deleted while we read
+            if gen == _categories_gen:
+                _cat_id_cache[cat_name] = cat_id
+        rows = await db.execute_fetchall("SELECT id, chat_id, msg_id FROM tasks WHERE cat_id = ? ORDER BY id", (cat_id,))
 
-    cat_id = row[0]
     data = await state.get_data()
     await delete_msg(message.bot, message.chat.id, data.get("last_mid"))
 
-    # Output content
-    async with db.execute("SELECT id, chat_id, msg_id FROM tasks WHERE cat_id = ?", (cat_id,)) as cursor:
-        async for tid, chat_id, msg_id in cursor:
-            try:
-                await message.bot.copy_message(
-                    message.chat.id, chat_id, msg_id,
-                    reply_markup=InlineKeyboardBuilder().button(text="🗑", callback_data=CatOpCB(action=Action.DELETE_TASK, id=tid)).as_markup()
-                )
-            except: continue
+    # Output content, in order; no connection is held while sending
+    for tid, chat_id, msg_id in rows:
+        await copy_task(message.bot, message.chat.id, tid, chat_id, msg_id)
 
     # Switch state to catch all messages
     await state.set_state(BotState.in_category)
     await state.update_data(current_cat_id=cat_id, current_cat_name=cat_name)
 
-    b = ReplyKeyboardBuilder().add(KeyboardButton(text="❌ Cancel"))
     msg = await message.answer(f"📍 Viewing: **{cat_name}**\n_Send anything to save it here._",
-                               parse_mode="Markdown", reply_markup=b.as_markup(resize_keyboard=True))
+                               parse_mode="Markdown", reply_markup=KBs.cancel_reply())
     await state.update_data(last_mid=msg.message_id)
 
 @dp.message(BotState.in_category)
-async def auto_save_handler(message: Message, state: FSMContext, db: aiosqlite.Connection):
+async def auto_save_handler(message: Message, state: FSMContext, db_pool: SQLiteConnectionPool):
     """Ловит всё, что прислано, пока юзер 'внутри' папки"""
     if message.text == "❌ Cancel": return # Filter handled by main handler
 
     data = await state.get_data()
     cat_id = data.get("current_cat_id")
 
-    await db.execute(
-        "INSERT INTO tasks (cat_id, chat_id, msg_id) VALUES (?, ?, ?)",
-        (cat_id, message.chat.id, message.message_id)
-    )
-    await db.commit()
+    cat_name = data.get("current_cat_name", "category")
+
+    # Confirm right away, the write lands while the confirmation is shown
+    saved = run_in_background(insert_task(db_pool, cat_id, message.chat.id, message.message_id))
     # Feedback without flooding
-    temp = await message.answer("✅ Saved to " + data.get("current_cat_name", "category"))
+    temp = await message.answer("✅ Saved to " + cat_name)
     await asyncio.sleep(1)
-    await temp.delete()
+    if await saved:
+        await temp.delete()
+    else:
+        await temp.edit_text("⚠️ Not saved, " + cat_name + " no longer exists or is unavailable")
 
-@dp.callback_query(CatOpCB.filter(F.action == Action.DELETE_TASK))
-async def delete_task(call: CallbackQuery, callback_data: CatOpCB, db: aiosqlite.Connection):
-    await db.execute("DELETE FROM tasks WHERE id = ?", (callback_data.id,))
-    await db.commit()
+@dp.callback_query(CallbackAction(Action.DELETE_TASK))
+async def delete_task(call: CallbackQuery, item_id: int, db_pool: SQLiteConnectionPool):
+    async with db_pool.connection() as db:
+        await db.execute("DELETE FROM tasks WHERE id = ?", (item_id,))
+        await db.commit()
     await call.message.delete()
     await call.answer("Deleted")
 
-@dp.callback_query(CatOpCB.filter(F.action == Action.ADD_NEW))
+@dp.callback_query(CallbackAction(Action.ADD_NEW))
 async def add_cat_init(call: CallbackQuery, state: FSMContext):
     await call.message.delete()
-    msg = await call.message.answer("Enter name:", reply_markup=ReplyKeyboardBuilder().add(KeyboardButton(text="❌ Cancel")).as_markup(resize_keyboard=True))
+    msg = await call.message.answer("Enter name:", reply_markup=KBs.cancel_reply())
     await state.set_state(BotState.waiting_new_cat)
     await state.update_data(last_mid=msg.message_id)
 
 @dp.message(BotState.waiting_new_cat)
-async def save_cat(message: Message, state: FSMContext, db: aiosqlite.Connection):
-    await db.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (message.text,))
-    await db.commit()
-    await cmd_start(message, db, state)
-
-@dp.callback_query(CatOpCB.filter(F.action == Action.EDIT_ITEM))
-async def edit_item_menu(call: CallbackQuery, callback_data: CatOpCB):
-    await call.message.edit_text(f"📝 Editing ID: {callback_data.id}", reply_markup=KBs.cat_edit_actions(callback_data.id))
-
-@dp.callback_query(CatOpCB.filter(F.action == Action.DELETE))
-async def del_cat(call: CallbackQuery, callback_data: CatOpCB, db: aiosqlite.Connection, state: FSMContext):
-    await db.execute("DELETE FROM tasks WHERE cat_id = ?", (callback_data.id,))
-    await db.execute("DELETE FROM categories WHERE id = ?", (callback_data.id,))
-    await db.commit()
-    await cmd_start(call.message, db, state)
+async def save_cat(message: Message, state: FSMContext, db_pool: SQLiteConnectionPool):
+    async with db_pool.connection() as db:
+        cursor = await db.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (message.text,))
+        await db.commit()
+        added = cursor.rowcount
+    # Duplicate names are ignored, keep the cached menu then
+    if added: invalidate_main_menu()
+    await cmd_start(message, db_pool, state)
+
+@dp.callback_query(CallbackAction(Action.EDIT_ITEM))
+async def edit_item_menu(call: CallbackQuery, item_id: int):
+    await call.message.edit_text(f"📝 Editing ID: {item_id}", reply_markup=KBs.cat_edit_actions(item_id))
+
+@dp.callback_query(CallbackAction(Action.DELETE))
+async def del_cat(call: CallbackQuery, item_id: int, db_pool: SQLiteConnectionPool, state: FSMContext):
+    async with db_pool.connection() as db:
+        cursor = await db.execute("DELETE FROM categories WHERE id = ?", (item_id,))
+        await db.commit()
+        deleted = cursor.rowcount
+    if deleted:
+        invalidate_main_menu()
+        forget_category(item_id)
+    await cmd_start(call.message, db_pool, state)
+
+async def connect_db() -> aiosqlite.Connection:
+    db = await aiosqlite.connect(DB_PATH)
+    for pragma in DB_PRAGMAS:
+        await db.execute(f"PRAGMA {pragma}")
+    return db
+
+async def migrate_tasks_fk(db: aiosqlite.Connection):
+    """Rebuilds a pre-cascade tasks table, dropping orphaned rows"""
+    if await db.execute_fetchall("PRAGMA foreign_key_list(tasks)"): return
+
+    logger.info("Migrating tasks table to ON DELETE CASCADE")
+    await db.executescript(f"""
+        BEGIN;
+        CREATE TABLE tasks_new {TASKS_DDL};
+        INSERT INTO tasks_new SELECT id, cat_id, chat_id, msg_id FROM tasks WHERE cat_id IN (SELECT id FROM categories);
+        DROP TABLE tasks;
+        ALTER TABLE tasks_new RENAME TO tasks;
+        CREATE INDEX idx_tasks_cat_id ON tasks(cat_id);
+        COMMIT;
+    """)
+
+async def ensure_schema(db: aiosqlite.Connection):
+    """Creates or upgrades the schema once, tracked via PRAGMA user_version"""
+    [(version,)] = await db.execute_fetchall("PRAGMA user_version")
+    if version >= SCHEMA_VERSION: return
+
+    await db.executescript(SCHEMA_SQL)
+    await migrate_tasks_fk(db)
+    await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
 async def main():
-    dotenv.load_dotenv()
-    async with aiosqlite.connect("../databases/tasks.db") as db:
-        await db.execute("CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
-        await db.execute("CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, cat_id INTEGER, chat_id INTEGER, msg_id INTEGER)")
-        await db.commit()
-        bot = Bot(token=os.getenv("BOT_TOKEN"))
-        dp.update.middleware(DbSessionMiddleware(db))
-        await dp.start_polling(bot)
+    async with SQLiteConnectionPool(connect_db, pool_size=DB_POOL_SIZE) as pool:
+        async with pool.connection() as db:
+            await ensure_schema(db)
+        bot = Bot(token=os.getenv("BOT_TOKEN"), session=KeepAliveSession(timeout=30))
+        dp.update.middleware(DbSessionMiddleware(pool))
+        try:
+            await dp.start_polling(bot)
+        finally:
+            # Flush pending saves before the pool closes
+            await asyncio.gather(*_background_tasks)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop: uvloop.run(main())
+    else: asyncio.run(main())